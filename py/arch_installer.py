@@ -34,19 +34,18 @@
 # - [ ] set timezone
 # - [x] ntp sync
 
-import inspect
+import asyncio
+import functools
 import os
 import subprocess
 import sys
 import textwrap
 import time
-from collections import namedtuple
 from textwrap import dedent, indent
 
 import blkinfo
 import dialog
-import pytz
-from humanfriendly import format_size, parse_size
+from humanfriendly import InvalidSize, format_size, parse_size
 from tzlocal import get_localzone
 
 from base import BaseDialog, DialogContextManager
@@ -93,18 +92,99 @@ params = {
     "progversion": progversion,
 }
 
+welcome_msg = """
+        Hello, and welcome to the Arch Installer {0}.\n\n
+        This script is being run by the Python interpreter identified as: {1}\n
+        """.format(
+    params["progversion"], indent(sys.version, "  ")
+)
+
 tw = textwrap.TextWrapper(width=78, break_long_words=True, break_on_hyphens=True)
 
+
+@functools.lru_cache(maxsize=16)
+def _wrap(msg):
+    return tw.fill(dedent(msg) + "\nPress Enter to continue.")
+
+
+dialog_unavailable_msg = _wrap(dialog_unavailable)
+
 persistent_dlg_args = [
     "--backtitle",
     "Arch Installer",
 ]
 
+persistent_dlg_args_escaped = dialog.Dialog.dash_escape_nf(persistent_dlg_args)
+
+reflector_mirrors = 200
+
+# --verbose makes reflector print a line per mirror, which drives the gauge.
+reflector_cmd = [
+    "reflector",
+    "--verbose",
+    "--latest",
+    str(reflector_mirrors),
+    "--protocol",
+    "http",
+    "--protocol",
+    "https",
+    "--sort",
+    "rate",
+    "--save",
+    "/etc/pacman.d/mirrorlist",
+]
+
+ntp_cmd = ["timedatectl", "set-ntp", "true"]
+
+
+_BOOTLOADER_CHOICES = (
+    (
+        "Systemd-boot",
+        "A simple UEFI boot loader",
+        "Systemd-boot (Bootctl) is simple to configure but it can only start EFI executables such as the Linux kernel EFISTUB, UEFI Shell, GRUB, or the Windows Boot Manager.",
+    ),
+    (
+        "Grub2",
+        "A very powerful boot loader",
+        "GNU GRUB is a very powerful boot loader, which can load a wide variety of free operating systems, as well as proprietary operating systems with chain-loading. GRUB is designed to address the complexity of booting a personal computer.",
+    ),
+)
+
+_SHELL_CHOICES = (
+    ("Bash", "The default login shell for most Linux distributions"),
+    ("Zsh", "Zsh is an extended Bourne shell with many improvements"),
+)
+
+_PARTITION_SCHEME_CHOICES = (
+    ("Single root partition", "simplest and should be enough for most use cases."),
+    ("Discrete partitions", "Separates paths as a partition"),
+)
+
 
 def caller(parent_func):
     return " ".join(parent_func[1:]), "_".join(parent_func)
 
 
+@functools.lru_cache(maxsize=1)
+def _localzone():
+    return str(get_localzone())
+
+
+@functools.lru_cache(maxsize=1)
+def _tz_choices():
+    import pytz
+
+    return [(tz, "%s timezone" % tz.partition("/")[0]) for tz in sorted(pytz.common_timezones_set)]
+
+
+_parse_size = functools.lru_cache(maxsize=64)(parse_size)
+
+
+@functools.lru_cache(maxsize=1)
+def _disks():
+    return blkinfo.BlkDiskInfo().get_disks()
+
+
 class ArchInstaller(object):
     user_input = {
         "add_swap": "",
@@ -121,15 +201,14 @@ class ArchInstaller(object):
     def __init__(self):
         self.Dlg = dialog.Dialog(dialog="dialog")
         self.d = BaseDialog(self.Dlg)
-        self.d.add_persistent_args(self.Dlg.dash_escape_nf(persistent_dlg_args))
+        self.d.add_persistent_args(persistent_dlg_args_escaped)
         self.dlg_dims = {"width": 0, "height": 0}
         self.max_lines, self.max_cols = self.d.maxsize(use_persistent_args=True)
         self.min_rows, self.min_cols = (24, 80)
         self.term_rows, self.term_cols, self.backend_version = self.get_term_size_and_sys_dlg_ver()
 
     def run(self):
-        self.welcome_user()
-        self.set_user_name()
+        self.set_user_name(welcome=True)
         self.set_user_password()
         self.set_root_password()
         self.set_user_shell()
@@ -147,37 +226,25 @@ class ArchInstaller(object):
     def get_term_size_and_sys_dlg_ver(self):
         backend_version = self.d.cached_backend_version
         if not backend_version:
-            sys.exit(self.warning_msg(dialog_unavailable))
+            sys.exit(self.warning_msg(dialog_unavailable_msg))
         term_rows, term_cols = self.d.maxsize(use_persistent_args=False)
         if term_rows < self.min_rows or term_cols < self.min_cols:
-            self.warning_msg(term_size_warning.format(self.min_rows, self.min_cols))
+            self.warning_msg(_wrap(term_size_warning.format(self.min_rows, self.min_cols)))
         return (term_rows, term_cols, backend_version)
 
     def simple_msg(self, msg, title):
         self.d.msgbox(msg, title)
 
-    def welcome_user(self):
-        self.d.msgbox(
-            """
-        Hello, and welcome to the Arch Installer {0}.\n\n
-        This script is being run by the Python interpreter identified as: {1}\n
-        """.format(
-                params["progversion"], indent(sys.version, "  ")
-            ),
-            title="Welcome to Arch Installer",
-            **self.dlg_dims
-        )
-
     def warning_msg(self, msg, *args):
-        print(tw.fill(dedent(msg) + "\nPress Enter to continue."))
+        print(msg)
         input()
 
     def confirm_selection(self, selection, **kwargs):
-        var, func = caller(str(inspect.stack()[1][3]).split("_"))
+        var, func = caller(sys._getframe(1).f_code.co_name.split("_"))
         msg = kwargs.get("msg", "'%s' is selected %s, continue?" % (selection, var))
         if self.d.yes_no(msg, title=("Confirm %s" % var)):
             return True
-        eval("self.%s()" % func)
+        getattr(self, func)()
 
     def run_reflector(self):
         cmd = "Reflector"
@@ -186,27 +253,37 @@ class ArchInstaller(object):
                 ("\nRun '%s'? It helps speed up package installs" % cmd),
                 title=("Speed up package downloads with %s" % cmd),
             ):
-                self.d.infobox(("Running '%s'" % cmd.lower()), title=cmd)
-                reflector_cmd = "reflector --latest 200 --protocol http --protocol https --sort rate --save /etc/pacman.d/mirrorlist"
-                self.run_sh_cmd(reflector_cmd, cmd)
+                self.d.gauge_start(("Running '%s'" % cmd.lower()), title=cmd, **self.dlg_dims)
+                start = time.time()
+                try:
+                    output = asyncio.run(self._run_reflector_async())
+                finally:
+                    self.d.gauge_stop()
+                self.report_sh_cmd(output, cmd, start)
             else:
                 return
 
+    async def _run_reflector_async(self):
+        proc = await asyncio.create_subprocess_exec(
+            *reflector_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+        )
+        lines = []
+        # The percent assumes roughly one output line per mirror; it is an
+        # estimate and is capped at 100.
+        async for line in proc.stdout:
+            lines.append(line)
+            self.d.gauge_update(
+                min(100, len(lines) * 100 // reflector_mirrors),
+                line.decode(errors="replace").strip(),
+                update_text=True,
+            )
+        await proc.wait()
+        return subprocess.CompletedProcess(reflector_cmd, proc.returncode, b"".join(lines))
+
     def set_bootloader(self):
         self.d.menu(
             "Select a bootloader to use",
-            choices=[
-                (
-                    "Systemd-boot",
-                    "A simple UEFI boot loader",
-                    "Systemd-boot (Bootctl) is simple to configure but it can only start EFI executables such as the Linux kernel EFISTUB, UEFI Shell, GRUB, or the Windows Boot Manager.",
-                ),
-                (
-                    "Grub2",
-                    "A very powerful boot loader",
-                    "GNU GRUB is a very powerful boot loader, which can load a wide variety of free operating systems, as well as proprietary operating systems with chain-loading. GRUB is designed to address the complexity of booting a personal computer.",
-                ),
-            ],
+            choices=_BOOTLOADER_CHOICES,
             title="Arch Installer",
             help_label="More info",
             help_button=True,
@@ -222,8 +299,19 @@ class ArchInstaller(object):
     def set_hostname(self):
         self.input_form()
 
-    def set_user_name(self):
-        self.input_form()
+    def set_user_name(self, welcome=False):
+        if not welcome:
+            return self.input_form()
+        while True:
+            code, outputs = (
+                self.d.chain()
+                .msgbox(welcome_msg, **self.dlg_dims)
+                .inputbox("What's your name?", init="")
+                .run(title="Welcome to Arch Installer")
+            )
+            if code == self.d.OK:
+                break
+        self.confirm_selection(outputs[-1])
 
     def password_form(self, user, error=""):
         while True:
@@ -238,12 +326,13 @@ class ArchInstaller(object):
                 insecure=True,
                 **self.dlg_dims
             )
-            if "" in fields:
+            password, confirm = fields
+            if not (password and confirm):
                 error = "ERROR: Password fields cant be empty."
-            elif fields[0] != fields[1]:
+            elif password != confirm:
                 error = "ERROR: Passwords do not match."
             else:
-                return fields[0]
+                return password
 
     def set_user_password(self):
         user_password = self.password_form(ArchInstaller.user_input.get("user_name"))
@@ -251,17 +340,14 @@ class ArchInstaller(object):
 
     def set_root_password(self):
         if self.d.yes_no("Set %s's password to be root password?", title="Root password"):
-            ArchInstaller.user_input.update({"root_password": ArchInstaller.user_input.get("user_password")})
-        ArchInstaller.user_input.update({"root_password": self.password_form("root")})
+            ArchInstaller.user_input["root_password"] = ArchInstaller.user_input["user_password"]
+            return
+        ArchInstaller.user_input["root_password"] = self.password_form("root")
 
     def set_user_shell(self):
         while True:
-            shells = [
-                ("Bash", "The default login shell for most Linux distributions"),
-                ("Zsh", "Zsh is an extended Bourne shell with many improvements"),
-            ]
             code, shell = self.d.menu(
-                "Select a system shell", menu_height=4, choices=shells, title="Shell selection", height=30
+                "Select a system shell", menu_height=4, choices=_SHELL_CHOICES, title="Shell selection", height=30
             )
             if code:
                 break
@@ -269,28 +355,20 @@ class ArchInstaller(object):
         ArchInstaller.shell = shell
 
     def set_drive(self):
-        Drive = namedtuple("Drive", ["name", "size", "partitions"])
+        drives = [
+            (
+                drive.get("name"),
+                "{0!r} is {1} and has {2} partitions".format(
+                    drive.get("name"), format_size(int(drive.get("size"))), len(drive.get("children") or [])
+                ),
+            )
+            for drive in _disks()
+        ]
         while True:
-            drives = [
-                Drive(
-                    name=(drive.get("name")),
-                    size=(format_size(int(drive.get("size")))),
-                    partitions=(drive.get("children")),
-                )
-                for drive in blkinfo.BlkDiskInfo().get_disks()
-            ]
             code, drive = self.d.menu(
                 "Select a drive to install Arch on",
                 menu_height=4,
-                choices=[
-                    (
-                        drive.name,
-                        "{0!r} is {1} and has {2} partitions".format(
-                            drive.name, drive.size, len(drive.partitions)
-                        ),
-                    )
-                    for drive in drives
-                ],
+                choices=drives,
                 title="Installation drive selection",
                 height=30,
             )
@@ -299,9 +377,9 @@ class ArchInstaller(object):
         self.confirm_selection(drive)
         ArchInstaller.install_drive = drive
 
-    def set_timezone(self, usr_tz=str(get_localzone())):
+    def set_timezone(self):
         while True:
-            usr_tz = str(get_localzone())
+            usr_tz = _localzone()
             if self.d.yes_no(
                 "Set {} as system timezone?".format(usr_tz),
                 no_label="Use different timezone",
@@ -312,10 +390,7 @@ class ArchInstaller(object):
             else:
                 code, usr_tz = self.d.menu(
                     "Timezone choices",
-                    choices=[
-                        [tz, "%s timezone" % str(tz).split("/")[0]]
-                        for tz in sorted(pytz.common_timezones_set)
-                    ],
+                    choices=_tz_choices(),
                     title="Timezone selection",
                     **self.dlg_dims
                 )
@@ -329,10 +404,7 @@ class ArchInstaller(object):
             sel, p_scheme = self.d.menu(
                 "Select a scheme",
                 menu_height=2,
-                choices=[
-                    ("Single root partition", "simplest and should be enough for most use cases."),
-                    ("Discrete partitions", "Separates paths as a partition"),
-                ],
+                choices=_PARTITION_SCHEME_CHOICES,
                 title="Partition schemes",
                 **self.dlg_dims
             )
@@ -349,31 +421,64 @@ class ArchInstaller(object):
         ArchInstaller.user_input.update({"add_swap": add_swap})
 
     def set_partition_sizes(self):
-        disk = blkinfo.BlkDiskInfo().get_disks({"name": self.user_input.get("install_drive")})[0]
+        disk = [d for d in _disks() if d.get("name") == self.user_input.get("install_drive")][0]
         disk_size = StorageInput(disk.get("size"))
-        boot, root, swap = StorageInput("250mb"), StorageInput("30gb"), StorageInput("10gb")
-        home_size = StorageInput(format_size(disk_size.raw - boot.raw + root.raw + swap.raw))
+        sizes = {"/boot": _BOOT_SI, "/": _ROOT_SI, "/swap": _SWAP_SI}
+        home_size = self.home_size(disk_size, sizes.values())
+        if home_size is None:
+            return
+        choices = [(path, format_size(size.raw)) for path, size in sizes.items()]
+        choices.append(("/home", home_size.humanized))
         while True:
-            partitions = self.d.inputmenu(
-                "Edit GPT partition defaults",
-                menu_height=5,
-                choices=[
-                    ("/boot", boot.humanized),
-                    ("/", root.humanized),
-                    ("/swap", swap.humanized),
-                    ("/home", home_size.humanized),
-                ],
-                height=30,
+            code, tag, size = self.d.inputmenu(
+                "Edit GPT partition defaults", menu_height=5, choices=choices, height=30,
             )
+            if code == "accepted":
+                break
+            if code != "renamed":
+                continue
+            if tag == "/home":
+                self.d.msgbox("/home takes the space left after the other partitions.", title="Partition sizes")
+                continue
+            edited = dict(sizes)
+            try:
+                edited[tag] = StorageInput.from_bytes(_parse_size(size))
+            except InvalidSize:
+                self.d.msgbox("{0!r} is not a valid size.".format(size), title="Partition sizes")
+                continue
+            home_size = self.home_size(disk_size, edited.values())
+            if home_size is None:
+                continue
+            sizes = edited
+            idx = next(i for i, (path, _) in enumerate(choices) if path == tag)
+            choices[idx] = (tag, sizes[tag].humanized)
+            choices[-1] = ("/home", home_size.humanized)
+        ArchInstaller.partition_sizes = dict(choices)
+
+    def home_size(self, disk_size, partitions):
+        home_raw = disk_size.raw - sum(size.raw for size in partitions)
+        if home_raw > 0:
+            return StorageInput.from_bytes(home_raw)
+        self.d.msgbox(
+            "The disk is {0} but /boot, / and /swap need {1}; no space is left for /home.".format(
+                format_size(disk_size.raw), format_size(sum(size.raw for size in partitions))
+            ),
+            title="Partition sizes",
+            **self.dlg_dims
+        )
+        return None
 
     def start_ntp_sync(self):
-        ntp_cmd = "timedatectl set-ntp true"
-        self.d.infobox(("Running '%s'" % ntp_cmd), title="NTP sync")
-        self.run_sh_cmd(ntp_cmd, ntp_cmd)
+        name = " ".join(ntp_cmd)
+        self.d.infobox(("Running '%s'" % name), title="NTP sync")
+        self.run_sh_cmd(ntp_cmd, name)
 
-    def run_sh_cmd(self, sh_cmd, name):
+    def run_sh_cmd(self, argv, name):
         start = time.time()
-        output = subprocess.run(sh_cmd, shell=True, check=True, capture_output=False)
+        output = subprocess.run(argv, bufsize=4096, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return self.report_sh_cmd(output, name, start)
+
+    def report_sh_cmd(self, output, name, start):
         total_time = round(time.time() - start, 2)
         if output.returncode == 0:
             self.d.msgbox(
@@ -382,10 +487,26 @@ class ArchInstaller(object):
                 **self.dlg_dims
             )
             return True
-        self.d.msgbox("{} failed to run.\n{}".format(name, output), title="{0!r} failure".format(name))
+        details = (output.stderr or output.stdout or b"").decode(errors="replace")
+        self.d.msgbox(
+            "{} failed to run (exit status {}).\n{}".format(name, output.returncode, details),
+            title="{0!r} failure".format(name),
+            **self.dlg_dims
+        )
+        return False
 
 
 class StorageInput(object):
     def __init__(self, val):
-        self.raw = parse_size(val)
+        self.raw = _parse_size(val)
         self.humanized = val
+
+    @classmethod
+    def from_bytes(cls, n):
+        storage = cls.__new__(cls)
+        storage.raw = n
+        storage.humanized = format_size(n)
+        return storage
+
+
+_BOOT_SI, _ROOT_SI, _SWAP_SI = StorageInput("250mb"), StorageInput("30gb"), StorageInput("10gb")
@@ -73,6 +73,10 @@ class BaseDialog:
         else:
             return obj
 
+    def chain(self):
+        """Start a DialogChain of widgets run in a single dialog process."""
+        return DialogChain(self)
+
     def clear_screen(self):
         """clear_screen."""
         program = "clear"
@@ -128,6 +132,60 @@ class BaseDialog:
         return d[code]
 
 
+class DialogChain:
+    """Builder for several widgets joined with --and-widget in one dialog call.
+    """
+
+    separator = "\x1f"
+
+    def __init__(self, base_dialog):
+        """__init__.
+        :param base_dialog:
+        """
+        self.base = base_dialog
+        self.widgets = []
+
+    def add(self, widget, *args):
+        """Append a widget given its dialog option name and positional arguments.
+        :param widget:
+        """
+        self.widgets.append(dialog.Dialog.dash_escape_nf(["--" + widget] + [str(arg) for arg in args]))
+        return self
+
+    def msgbox(self, text, height=0, width=0):
+        """msgbox.
+        :param text:
+        """
+        return self.add("msgbox", text, height, width)
+
+    def inputbox(self, text, height=0, width=0, init=""):
+        """inputbox.
+        :param text:
+        """
+        return self.add("inputbox", text, height, width, init)
+
+    def _run(self, **kwargs):
+        args = ["--separate-widget", self.separator]
+        for i, widget in enumerate(self.widgets):
+            if i:
+                args.append("--and-widget")
+            args.extend(widget)
+        # Widget arguments are escaped in add(); escaping again here would
+        # turn --and-widget and the widget options into plain text.
+        code, output = self.base.dlg._perform(args, dash_escape="none", **kwargs)
+        return code, output.split(self.separator)
+
+    def run(self, **kwargs):
+        """Run the chained widgets and return (code, outputs).
+
+        kwargs are common dialog options (e.g. title) passed to _perform.
+        Whether a widget that prints nothing (e.g. msgbox) yields an entry
+        in outputs depends on the dialog backend, so callers should index
+        outputs from the end.
+        """
+        return self.base.widget_loop(self._run)(**kwargs)
+
+
 class DialogContextManager:
     def __enter__(self):
         return self